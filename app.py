@@ -1,16 +1,41 @@
 import streamlit as st
 import requests
-import xml.etree.ElementTree as ET
+from requests.adapters import HTTPAdapter
+import urllib3
+from urllib3.util import Retry
+from lxml import etree
 import pandas as pd
 from itertools import chain
 from collections import Counter
-from wordcloud import WordCloud
-import matplotlib.pyplot as plt
 import re
+import hashlib
+import orjson
+import logging
+import time
+import shelve
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+@st.cache_resource
+def get_session():
+    # One pooled session for PubMed and Hugging Face, reused across reruns
+    session = requests.Session()
+    # Connection errors, rate limiting and gateway failures are retried with
+    # backoff (honouring Retry-After). The last
+    # response is returned rather than raised so callers can inspect a 503.
+    retry = Retry(total=3, backoff_factor=1, status_forcelist=[429, 502, 503, 504],
+                  allowed_methods=["GET", "POST"], raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=16, pool_maxsize=16, max_retries=retry)
+    session.mount("https://", adapter)
+    return session
 
 st.set_page_config(page_title="PubMed Hot Topics HF", layout="wide")
 st.title("🔍 PubMed Hot Topics Explorer (Hugging Face NER)")
 
+SESSION = get_session()
+
 query = st.text_area(
     "PubMed Search Query", 
     value='("Endocrinology" OR "Diabetes") AND 2024/10/01:2025/06/28[Date - Publication]'
@@ -19,89 +44,258 @@ max_results = st.number_input("Max number of articles", min_value=10, max_value=
 hf_token = st.text_input("Hugging Face API Token", type="password")
 hf_model = "d4data/biobert-cased-finetuned-ner"
 
-generic_terms = set([
+generic_terms = frozenset([
     "study", "patient", "patients", "trial", "results", "effect", "effects",
     "group", "clinical", "analysis", "evaluation", "treatment", "data"
 ])
 
+NON_WORD = re.compile(r'\W+')
+# Deletes ASCII non-word characters (same set as \W) without the regex engine
+ASCII_NON_WORD = str.maketrans('', '', ''.join(
+    c for c in map(chr, range(128)) if not (c.isalnum() or c == '_')
+))
+
+def clean_token(e):
+    if e.isascii():
+        return e.translate(ASCII_NON_WORD).lower()
+    return NON_WORD.sub('', e).lower()
+
+# Precompiled XPath expressions for PubmedArticle fields
+XP_PMID = etree.XPath("string(MedlineCitation/PMID)")
+XP_TITLE = etree.XPath("string(MedlineCitation/Article/ArticleTitle)")
+XP_JOURNAL = etree.XPath("string(MedlineCitation/Article/Journal/Title)")
+XP_YEAR = etree.XPath("string(MedlineCitation/Article/Journal/JournalIssue/PubDate/Year)")
+XP_MEDLINE_DATE = etree.XPath("string(MedlineCitation/Article/Journal/JournalIssue/PubDate/MedlineDate)")
+
+HF_MAX_WAIT = 60
+
+# Hugging Face NER (batched: the Inference API accepts a list of inputs)
+def get_entities(texts, hf_token, hf_model, generic_terms):
+    """Run NER on a batch of titles. Returns None if the request failed."""
+    headers = {"Authorization": f"Bearer {hf_token}"}
+    url = f"https://api-inference.huggingface.co/models/{hf_model}"
+    try:
+        r = SESSION.post(url, headers=headers, json={"inputs": texts}, timeout=30)
+        if r.status_code == 503:
+            # Model is cold: wait for the time HF estimates it needs, then retry once
+            estimated_time = orjson.loads(r.content).get("estimated_time")
+            if estimated_time is not None:
+                time.sleep(min(float(estimated_time), HF_MAX_WAIT))
+                r = SESSION.post(url, headers=headers, json={"inputs": texts}, timeout=30)
+        if r.status_code == 200:
+            batch = orjson.loads(r.content)
+            # A short or malformed response cannot be aligned with the inputs
+            if not isinstance(batch, list) or len(batch) != len(texts):
+                return None
+            is_generic = generic_terms.__contains__
+            filtered = []
+            for ents in batch:
+                words = [e['word'] for e in ents if 'word' in e]
+                filtered.append([w for w in words if not is_generic(w.lower())])
+            return filtered
+    except:
+        pass
+    return None
+
+NER_CACHE_PATH = ".ner_cache"
+NER_CACHE_TTL = 86400
+
+@st.cache_resource
+def get_ner_cache():
+    # Per-title NER results persisted on disk, shared by every session
+    return shelve.open(NER_CACHE_PATH), threading.Lock()
+
+def get_entities_batched(texts, hf_token, hf_model, generic_terms, batch_size=32, max_workers=8):
+    """Returns the entity lists and whether every batch succeeded."""
+    results = [[] for _ in texts]
+    if not hf_token:
+        return results, True
+    cache, lock = get_ner_cache()
+    prefix = f"{hf_model}\0{','.join(sorted(generic_terms))}\0"
+    now = time.time()
+    # Serve cached titles, and only send the non-empty misses to the API
+    misses = []
+    with lock:
+        for i, t in enumerate(texts):
+            if not t or not t.strip():
+                continue
+            hit = cache.get(prefix + t)
+            if hit is not None and now - hit[0] < NER_CACHE_TTL:
+                results[i] = hit[1]
+            else:
+                misses.append((i, t))
+    chunks = [misses[i:i + batch_size] for i in range(0, len(misses), batch_size)]
+    ner_ok = True
+    # Requests are I/O-bound, so overlap them in a bounded thread pool
+    with ThreadPoolExecutor(max_workers=max_workers) as ex:
+        batches = ex.map(lambda chunk: get_entities([t for _, t in chunk], hf_token, hf_model, generic_terms), chunks)
+        for chunk, batch in zip(chunks, batches):
+            # Failed batches are left out of the cache so the next run retries them
+            if batch is None:
+                ner_ok = False
+                continue
+            with lock:
+                for (i, t), ents in zip(chunk, batch):
+                    results[i] = ents
+                    cache[prefix + t] = (now, ents)
+                cache.sync()
+    return results, ner_ok
+
+EFETCH_CHUNK = 50
+# Concurrency only overlaps slow downloads; the request rate is capped by
+# the NCBI throttle below
+EFETCH_WORKERS = 3
+# NCBI E-utilities allow 3 requests per second without an API key
+NCBI_MIN_INTERVAL = 1 / 3
+
+class RequestThrottle:
+    """Spaces request starts at least `interval` seconds apart across threads."""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.next_slot = 0.0
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        time.sleep(slot - now)
+
+@st.cache_resource
+def get_ncbi_throttle():
+    # Shared by every session, since NCBI counts requests per client IP
+    return RequestThrottle(NCBI_MIN_INTERVAL)
+
+def fetch_articles(ids):
+    """Fetch one chunk of PMIDs and parse it into column lists."""
+    efetch_url = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi"
+    params = {"db": "pubmed", "id": ",".join(ids), "retmode": "xml"}
+    pmids, titles, journals, dates = [], [], [], []
+    parse_ok = True
+    # Stream the XML straight into the parser instead of buffering it whole
+    headers = {"Accept-Encoding": "gzip, deflate"}
+    try:
+        get_ncbi_throttle().wait()
+        with SESSION.get(efetch_url, params=params, headers=headers, stream=True, timeout=20) as response:
+            if response.status_code != 200:
+                logger.warning("efetch returned HTTP %s for %d PMIDs", response.status_code, len(ids))
+                return pmids, titles, journals, dates, False
+            logger.debug("efetch Content-Encoding: %s", response.headers.get("Content-Encoding"))
+            # Decompress on the fly so decoding overlaps with parsing
+            response.raw.decode_content = True
+            for _, article in etree.iterparse(response.raw, tag="PubmedArticle"):
+                pmids.append(XP_PMID(article))
+                titles.append(XP_TITLE(article))
+                journals.append(XP_JOURNAL(article))
+                dates.append(XP_YEAR(article) or XP_MEDLINE_DATE(article) or "N/A")
+                # Free the parsed article and already-processed siblings
+                article.clear()
+                while article.getprevious() is not None:
+                    del article.getparent()[0]
+    except (requests.RequestException, urllib3.exceptions.HTTPError, etree.Error):
+        # A failed chunk is reported to the caller instead of aborting the run
+        logger.warning("efetch failed for %d PMIDs", len(ids), exc_info=True)
+        parse_ok = False
+    return pmids, titles, journals, dates, parse_ok
+
+# Bigrams and trigrams are counted together in a single pass over the tokens
+def count_bigrams_trigrams(cleaned):
+    bigrams, trigrams = Counter(), Counter()
+    update_bi, update_tri = bigrams.update, trigrams.update
+    join = " ".join
+    for tokens in cleaned:
+        n = len(tokens)
+        update_bi(join(tokens[i:i+2]) for i in range(n - 1))
+        update_tri(join(tokens[i:i+3]) for i in range(n - 2))
+    return bigrams, trigrams
+
+class IncompleteResult(Exception):
+    """Raised out of run_pipeline so partial results are shown but never cached."""
+
+    def __init__(self, result, parse_ok, ner_ok):
+        super().__init__("PubMed fetch or NER did not complete")
+        self.result = result
+        self.parse_ok = parse_ok
+        self.ner_ok = ner_ok
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def run_pipeline(query, max_results, hf_model, hf_token_hash, _hf_token=None):
+    """Fetch, parse and run NER. The token hash stands in for the token in the cache key."""
+    # Buscar PMIDs
+    esearch_url = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esearch.fcgi"
+    params = {"db": "pubmed", "retmax": str(max_results), "retmode": "json", "term": query}
+    get_ncbi_throttle().wait()
+    r = SESSION.get(esearch_url, params=params)
+    id_list = orjson.loads(r.content)["esearchresult"].get("idlist", [])
+
+    # Fetch and parse PMIDs in chunks so downloads and parsing overlap
+    chunks = [id_list[i:i + EFETCH_CHUNK] for i in range(0, len(id_list), EFETCH_CHUNK)]
+    pmids, titles, journals, dates = [], [], [], []
+    parse_ok = True
+    with ThreadPoolExecutor(max_workers=EFETCH_WORKERS) as ex:
+        for chunk_pmids, chunk_titles, chunk_journals, chunk_dates, chunk_ok in ex.map(fetch_articles, chunks):
+            pmids += chunk_pmids
+            titles += chunk_titles
+            journals += chunk_journals
+            dates += chunk_dates
+            parse_ok = parse_ok and chunk_ok
+
+    # object dtype keeps the Link concatenation valid when no articles were parsed
+    df = pd.DataFrame({"PMID": pmids, "Title": titles, "Journal": journals, "Date": dates}, dtype=object)
+    df.insert(2, "Link", "https://pubmed.ncbi.nlm.nih.gov/" + df["PMID"] + "/")
+    ner_ok = True
+    if not df.empty:
+        df['entities'], ner_ok = get_entities_batched(df['Title'].tolist(), _hf_token, hf_model, generic_terms)
+    else:
+        df['entities'] = []
+
+    word_freq = Counter(chain.from_iterable(df['entities']))
+    cleaned = [[clean_token(e) for e in entities if e] for entities in df['entities']]
+    bigram_freq, trigram_freq = count_bigrams_trigrams(cleaned)
+    result = (df, word_freq, bigram_freq, trigram_freq)
+    if not (parse_ok and ner_ok):
+        raise IncompleteResult(result, parse_ok, ner_ok)
+    return result
+
+# Wordcloud rendering is cached on the (hashable) frequency items. Each entry
+# is an ~1 MB RGB array, so the cache is bounded and expires with run_pipeline.
+@st.cache_data(ttl=3600, max_entries=32, show_spinner=False)
+def render_wc(freq_items):
+    from wordcloud import WordCloud
+
+    wc = WordCloud(width=800, height=400, background_color='white').generate_from_frequencies(dict(freq_items))
+    return wc.to_array()
+
+# Wordcloud function
+def plot_wordcloud(word_freq, title):
+    if word_freq:
+        st.subheader(title)
+        st.image(render_wc(tuple(sorted(word_freq.items()))), width="stretch")
+    else:
+        st.info(f"No entities found to generate {title}.")
+
 if st.button("🔎 Run Analysis"):
-    with st.spinner("Fetching articles..."):
-        # Buscar PMIDs
-        esearch_url = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esearch.fcgi"
-        params = {"db": "pubmed", "retmax": str(max_results), "retmode": "json", "term": query}
-        r = requests.get(esearch_url, params=params)
-        id_list = r.json()["esearchresult"].get("idlist", [])
-
-        efetch_url = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi"
-        params = {"db": "pubmed", "id": ",".join(id_list), "retmode": "xml"}
-        response = requests.get(efetch_url, params=params, timeout=20)
-
-        records = []
+    with st.spinner("Fetching articles and running Hugging Face NER on article titles..."):
+        hf_token_hash = hashlib.sha256(hf_token.encode()).hexdigest() if hf_token else ""
         try:
-            root = ET.fromstring(response.content)
-            articles = root.findall(".//PubmedArticle")
-            for article in articles:
-                pmid = article.findtext(".//PMID")
-                title = article.findtext(".//ArticleTitle", "")
-                link = f"https://pubmed.ncbi.nlm.nih.gov/{pmid}/"
-                journal = article.findtext(".//Journal/Title", "")
-                date = article.findtext(".//PubDate/Year") or article.findtext(".//PubDate/MedlineDate") or "N/A"
-                records.append({"PMID": pmid, "Title": title, "Link": link, "Journal": journal, "Date": date})
-        except:
-            st.error("Failed to parse PubMed XML.")
-
-        df = pd.DataFrame(records)
-
-        # Hugging Face NER
-        def get_entities(text):
-            if not hf_token or not text.strip():
-                return []
-            headers = {"Authorization": f"Bearer {hf_token}"}
-            payload = {"inputs": text}
-            try:
-                r = requests.post(f"https://api-inference.huggingface.co/models/{hf_model}",
-                                  headers=headers, json=payload, timeout=30)
-                if r.status_code == 200:
-                    ents = r.json()
-                    return [e['word'] for e in ents if 'word' in e and e['word'].lower() not in generic_terms]
-            except:
-                return []
-            return []
-
-        st.info("Running Hugging Face NER on article titles...")
-        df['entities'] = df['Title'].apply(get_entities)
-
-        # N-grams
-        def get_ngrams(entity_lists, n=2):
-            ngrams = []
-            for entities in entity_lists:
-                tokens = [re.sub(r'\W+', '', e).lower() for e in entities if e]
-                ngrams.extend([" ".join(tokens[i:i+n]) for i in range(len(tokens)-n+1)])
-            return ngrams
-
-        bigrams = get_ngrams(df['entities'], n=2)
-        trigrams = get_ngrams(df['entities'], n=3)
-
-        # Wordcloud function
-        def plot_wordcloud(words, title):
-            if words:
-                word_freq = Counter(words)
-                wc = WordCloud(width=800, height=400, background_color='white').generate_from_frequencies(word_freq)
-                plt.figure(figsize=(15,6))
-                plt.imshow(wc, interpolation='bilinear')
-                plt.axis('off')
-                st.subheader(title)
-                st.pyplot(plt)
-                plt.close()
-            else:
-                st.info(f"No entities found to generate {title}.")
+            df, word_freq, bigram_freq, trigram_freq = run_pipeline(
+                query, max_results, hf_model, hf_token_hash, _hf_token=hf_token
+            )
+        except IncompleteResult as e:
+            df, word_freq, bigram_freq, trigram_freq = e.result
+            if not e.parse_ok:
+                st.error("Failed to parse PubMed XML.")
+            if not e.ner_ok:
+                st.warning("Hugging Face NER failed for some titles. Run the analysis again to retry them.")
 
-        plot_wordcloud(list(chain.from_iterable(df['entities'])), "Wordcloud - Single Words")
-        plot_wordcloud(bigrams, "Wordcloud - Bigrams")
-        plot_wordcloud(trigrams, "Wordcloud - Trigrams")
+        plot_wordcloud(word_freq, "Wordcloud - Single Words")
+        plot_wordcloud(bigram_freq, "Wordcloud - Bigrams")
+        plot_wordcloud(trigram_freq, "Wordcloud - Trigrams")
 
         # DataFrame e CSV
         st.subheader("Article Table")
-        st.dataframe(df[['PMID','Title','Journal','Date','entities']], use_container_width=True)
+        st.dataframe(df[['PMID','Title','Journal','Date','entities']], width="stretch")
         csv = df.to_csv(index=False)
         st.download_button("⬇️ Download CSV", data=csv, file_name="pubmed_entities.csv", mime="text/csv")